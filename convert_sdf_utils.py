@@ -27,15 +27,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
 import os
+import re
+from concurrent import futures
 
-import numpy as np
 import tensorflow as tf
 from absl import app
 from absl import flags
 from absl import logging
 from openbabel import pybel
 from rdkit import Chem
+from rdkit import RDLogger
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('path_to_bad_sdf',
@@ -47,6 +50,11 @@ flags.DEFINE_string('failed_block_file_name',
 flags.DEFINE_string('output_dir',
                     '',
                     'specify a directory for SDF files converted.')
+flags.DEFINE_integer('num_workers',
+                     None,
+                     'specify how many processes to convert molecules in parallel, '
+                     'by default the number of processors on the machine, 1 to convert them in process.',
+                     lower_bound=1)
 
 # required tags in sdf files.
 SDF_TAG_MASS_SPEC_PEAKS = 'MASS SPECTRAL PEAKS'
@@ -61,67 +69,166 @@ expected_props = [SDF_TAG_MASS_SPEC_PEAKS,
                   SDF_TAG_NAME,
                   SDF_TAG_MOLECULE_MASS]
 
+# prefix of InChI strings.
+_INCHI_PREFIX = 'InChI='
 
-def _make_mol_block_from_string(mol_str_in_lines):
-    """ Make a molecule block from a string read by Chem.SDMolSupplier
+# tag lines of the properties added up to each molecule block.
+_INCHI_TAG_LINE = '>  <%s>' % SDF_TAG_INCHI
+_INCHIKEY_TAG_LINE = '>  <%s>' % SDF_TAG_INCHIKEY
+
+# size of molecule blocks (in characters) gathered before each write to a file.
+_WRITE_BUFFER_SIZE = 1 << 20
+
+# the four dollar signs ($$$$) line ending a molecule string.
+_MOL_END_LINE = '\n$$$$'
+
+# matches four dollar signs ($$$$) starting a line of a sdf-like data file, as those ending a molecule string, but
+# not those in property values. Trailing whitespace is matched but not a trailing '\r', which stays as it is.
+_RAW_MOL_END_LINE_PATTERN = re.compile(br'^\$\$\$\$[ \t]*(?=\r?$)', re.MULTILINE)
+
+# tag lines of the expected properties, in the order they are checked for. INCHI and INCHIKEY are added up to
+# every molecule block while converting, so they come last, after the properties taken as is from MoNA.
+_CHECK_PROP_TAG_LINES = tuple('>  <%s>' % prop_key for prop_key in (SDF_TAG_MOLECULE_MASS,
+                                                                    SDF_TAG_NAME,
+                                                                    SDF_TAG_MASS_SPEC_PEAKS,
+                                                                    SDF_TAG_INCHI,
+                                                                    SDF_TAG_INCHIKEY))
+
+
+def _read_mol_str_list(path_to_bad_sdf):
+    """ Read all the molecule strings from a sdf-like data file.
+
+    The whole file is read at once and split on the lines of four dollar signs ($$$$) ending each molecule, so that
+    molecule strings are separated by a single regex split instead of line by line.
+
+    Args:
+        path_to_bad_sdf: Path to load a sdf-like data file.
+
+    Returns:
+        A list of string for molecules, each of which ends with the four dollar signs ($$$$), except for a molecule
+        string left after the last four dollar signs if the file does not end with them.
+    """
+
+    with tf.gfile.Open(path_to_bad_sdf, 'rb') as reader:
+        raw_mol_strs = _RAW_MOL_END_LINE_PATTERN.split(reader.read())
+
+    # blank strings between two four dollar signs ($$$$) are not molecules. Undecodable bytes are replaced, rather
+    # than failing the whole file for a single corrupted molecule.
+    mol_str_list = [raw_mol_str.decode('utf-8', 'replace') + '$$$$'
+                    for raw_mol_str in raw_mol_strs[:-1] if raw_mol_str.strip()]
+
+    # the string after the last four dollar signs ($$$$) is kept as it is, so that it ends up in failed molecule
+    # blocks rather than being dropped silently.
+    if raw_mol_strs[-1].strip():
+        logging.warning('%s does not end with four dollar signs ($$$$), the last molecule string may be truncated.',
+                        path_to_bad_sdf)
+        mol_str_list.append(raw_mol_strs[-1].decode('utf-8', 'replace'))
+    return mol_str_list
+
+
+@functools.lru_cache(maxsize=None)
+def _inchi_to_inchikey(inchi):
+    """ Convert an InChI, without its 'InChI=' prefix, to the corresponding InChIKey.
+
+    Molecules in MoNA often share an InChI, e.g. spectra of the same compound, so InChIKeys are cached by InChI.
+
+    Args:
+        inchi: A string for InChI. It is taken from the COMMENT section of a SDF data file.
+
+    Returns:
+        InChIKey of the InChI, or '' if InChI is empty.
+    """
+
+    if not inchi:
+        return ''
+    inchikey = Chem.inchi.InchiToInchiKey(_INCHI_PREFIX + inchi)
+    # logging.warning('InChI %s has a InChiKey %s', inchi, inchikey)
+    # uncomment for logging InChi and its InChiKey
+    return inchikey
+
+
+def _insert_before_line(mol_str, mark, insertion):
+    """ Insert a string at the start of the first line containing a mark, if any.
+
+    Only the first line containing the mark is handled, since the counts line (V2000) and the NAME tag line this
+    is used for occur once in a molecule string. Later lines containing the mark are left as they are.
+    """
+
+    mark_start = mol_str.find(mark)
+    if mark_start < 0:
+        return mol_str
+    line_start = mol_str.rfind('\n', 0, mark_start) + 1
+    return mol_str[:line_start] + insertion + mol_str[line_start:]
+
+
+def _make_mol_block_from_string(mol_str):
+    """ Make a molecule block from a string read from a sdf-like data file
 
     A valid molecule header should have three separated lines: title line, program line and  counts line.
     The missing lines in the original dataset files are filled up with new blank lines (''). To restored molecules
     from a SDF data file, it needs to include 'M  END' as molecule reading end flag. Due to google's
     Neural Electron−Ionization Mass Spectrometry (NEIMS) demanding InChIKey, I extracted InChI from
     the comment section in SDF data files, and then transfer them to the corresponding InChiKey,
-    and write them back to molecule blocks in SDF data files.
+    and write them back to molecule blocks in SDF data files. Both are only added up if the molecule string ends with
+    a line of four dollar signs ($$$$).
 
     Args:
-        mol_str_in_lines: List of string for molecule descriptions.
+        mol_str: A string for molecule descriptions.
 
     Returns:
-        A list of string for molecule block.
+        A string for molecule block.
     """
 
-    block = []
-    for line in mol_str_in_lines:
-        if "V2000" in line:  # insert a required lines in molecule header block.
-            block.extend(['', line])
-        elif ">  <NAME>" in line:  # mark M  END as an token for a valid molecule.
-            block.extend(['M  END', line])
-        elif "$$$$" in line:  # add up two properties, including INCHIKEY and INCHI before ending a molecule block.
-            inchikey = ''
-            inchi = _get_prop_value_from_mol_block(block, SDF_TAG_INCHI)
-            if inchi:
-                inchikey = Chem.inchi.InchiToInchiKey('InChI=' + inchi)
-                # logging.warning('InChI %s has a InChiKey %s', inchi, inchikey)
-                # uncomment for logging InChi and its InChiKey
-            block.extend(['>  <%s>' % 'INCHI', inchi, ''])
-            block.extend(['>  <%s>' % SDF_TAG_INCHIKEY, inchikey, '', line])
-        else:
-            block.append(line)
-    return block
-
-
-def _make_mol_block_rational(mol_block):
+    # rather than walking the molecule string line by line, the lines to handle are located by searching the whole
+    # string at once. MoNA mixes '\r\n' and '\n' line breaks, so they are unified first.
+    mol_str = mol_str.strip().replace('\r\n', '\n').replace('\r', '\n')
+    mol_str = _insert_before_line(mol_str, 'V2000', '\n')  # insert a required lines in molecule header block.
+    mol_str = _insert_before_line(mol_str, '>  <NAME>', 'M  END\n')  # mark M  END as an token for a valid molecule.
+    if not mol_str.endswith(_MOL_END_LINE):
+        return mol_str
+
+    # add up two properties, including INCHIKEY and INCHI before ending a molecule block. Those already in the
+    # molecule block, e.g. INCHIKEY given by MoNA, are not added up again, which would override them when loaded.
+    mol_block = mol_str[:-len(_MOL_END_LINE)]
+    block = [mol_block]
+    inchi = _get_prop_value_from_mol_block(mol_block, SDF_TAG_INCHI)
+    if not _has_prop_on_mol_block(mol_block, SDF_TAG_INCHI):
+        block.extend([_INCHI_TAG_LINE, inchi, ''])
+    if not _has_prop_on_mol_block(mol_block, SDF_TAG_INCHIKEY):
+        block.extend([_INCHIKEY_TAG_LINE, _inchi_to_inchikey(inchi), ''])
+    block.append('$$$$')
+    return '\n'.join(block)
+
+
+def _make_mol_block_rational(mol_str):
     """ Make molecule blocks passed parse successfully.
 
     Note that although some missing lines and a molecule reading flag (M END) has been filled up,
     for some unknown reasons, considerable molecule blocks can not be successfully recognized as expected.
     I found that OpenBabel can calibrate those. The reason this phenomenon may
-    lie in wrong values in their atom blocks values, making molecule blocks corrupted.
+    lie in wrong values in their atom blocks values, making molecule blocks corrupted. Molecule blocks RDKit
+    already loads are kept as they are, only the others go through OpenBabel.
 
     Args:
-        mol_block: A raw mol_block (list of string )
+        mol_str: A raw molecule block (string).
 
     Returns
-        A molecule block whose atom block is calibrated, if molecule block is successfully loaded as sdf,
-        otherwise, None.
+        A tuple (mol_block, num_atoms). mol_block is a molecule block whose atom block is calibrated, if molecule
+        block is successfully loaded as sdf, otherwise, None. num_atoms is the number of atoms of the molecule
+        loaded, or 0 if it can not be loaded.
     """
 
-    mol_str = '\n'.join(mol_block)
+    # hydrogens are kept so that atoms are counted as OpenBabel does.
+    mol = Chem.MolFromMolBlock(mol_str, removeHs=False)
+    if mol is not None:
+        return mol_str + '\n', mol.GetNumAtoms()
+
     try:
         mol_obj = pybel.readstring('sdf', mol_str)
     except IOError:
-        mol_obj = None
+        return None, 0
 
-    return mol_obj.write('sdf').splitlines() if mol_obj is not None else None
+    return mol_obj.write('sdf'), len(mol_obj.atoms)
 
 
 def _has_prop_on_mol_block(block, prop_key):
@@ -144,12 +251,14 @@ def _has_prop_on_mol_block(block, prop_key):
     """
 
     if prop_key not in expected_props:
-        raise ValueError('%s is not a supported property type.', prop_key)
-    has_prop = False
-    for line in block:
-        if line.strip() == ('>  <%s>' % prop_key):
-            has_prop = True
-    return has_prop
+        raise ValueError('%s is not a supported property type.' % prop_key)
+    return ('>  <%s>' % prop_key) in block
+
+
+@functools.lru_cache(maxsize=None)
+def _get_prop_tag_line_pattern(prop_key_full_name):
+    """ Compile a pattern matching the tag line of a property, allowing whitespace around the tag on the line."""
+    return re.compile(r'^[ \t]*%s[ \t\r]*$' % re.escape(prop_key_full_name), re.MULTILINE)
 
 
 def _get_prop_value_from_mol_block(block, prop_key):
@@ -159,7 +268,7 @@ def _get_prop_value_from_mol_block(block, prop_key):
     start with 'InChI=InChI'.
 
     Args:
-        block: A list of string to specify a molecule block.
+        block: A string to specify a molecule block.
         prop_key: A string to specify key of a property of molecules.
 
     Returns:
@@ -167,61 +276,116 @@ def _get_prop_value_from_mol_block(block, prop_key):
         return ''.
     """
 
-    if _has_prop_on_mol_block(block, prop_key) or prop_key == SDF_TAG_INCHI:
-        prop_key_full_name = ('>  <%s>' % prop_key.upper())
-        comment_key_full_name = '>  <COMMENT>'
-        prop_value = ''
-        if prop_key_full_name == '>  <INCHI>':
-            prop_key_full_name = '>  <COMMENT>'
-        for ind, line in enumerate(block):
-
-            if prop_key_full_name == comment_key_full_name and prop_key_full_name == line.strip():
-                if block[ind + 1].startswith('InChI='):
-                    prop_value = block[ind + 1].strip('InChI=')
-                    break
-            elif prop_key_full_name == line.strip():
-                prop_value = block[ind + 1].strip('')
-                break
-        return prop_value
+    if prop_key not in expected_props:
+        raise ValueError('%s is not a supported property type.' % prop_key)
+    prop_key_full_name = '>  <%s>' % prop_key.upper()
+    if prop_key == SDF_TAG_INCHI:
+        prop_key_full_name = '>  <COMMENT>'
+
+    # the value is the line next to the tag line of the property.
+    prop_tag_line_match = _get_prop_tag_line_pattern(prop_key_full_name).search(block)
+    if prop_tag_line_match is None:
+        return ''
+    value_start = prop_tag_line_match.end() + 1
+    value_end = block.find('\n', value_start)
+    if value_end < 0:
+        value_end = len(block)
+    prop_value = block[value_start:value_end].strip()
+
+    if prop_key == SDF_TAG_INCHI:
+        # the first line of COMMENT looks like 'InChI=InChI=1S/...', drop both of the leading 'InChI='.
+        if not prop_value.startswith(_INCHI_PREFIX):
+            return ''
+        prop_value = prop_value[len(_INCHI_PREFIX):]
+        if prop_value.startswith(_INCHI_PREFIX):
+            prop_value = prop_value[len(_INCHI_PREFIX):]
+    return prop_value
 
 
 def _write_mol_block_to_file(save_to_path, mol_block_list):
-    """ Write a molecule block to a file"""
+    """ Write molecule blocks to a file, opening it only once.
 
-    def __mol_block_writer(mode):
-        with tf.gfile.Open(save_to_path, mode) as writer:
-            for line in mol_block:
-                writer.write('%s\n' % line)
+    Molecule blocks are gathered up to about _WRITE_BUFFER_SIZE characters and written together, so that a file
+    is written with a few large writes rather than one write per molecule block.
+    """
 
-    for index, mol_block in enumerate(mol_block_list):
-        if index == 0:
-            __mol_block_writer(mode='w')
-        else:
-            __mol_block_writer(mode='a')
+    with tf.gfile.Open(save_to_path, 'w') as writer:
+        buffered_blocks = []
+        buffered_size = 0
+        for mol_block in mol_block_list:
+            buffered_blocks.append(mol_block)
+            buffered_size += len(mol_block)
+            if buffered_size >= _WRITE_BUFFER_SIZE:
+                writer.write(''.join(buffered_blocks))
+                buffered_blocks = []
+                buffered_size = 0
+        if buffered_blocks:
+            writer.write(''.join(buffered_blocks))
 
 
 def _check_mol_block_has_all_prop(mol_block):
     """ Check if all the considered properties exist in the molecule block."""
-    prop_check_status = []
-    for mol_prop_key in expected_props:
-        prop_check_status.append(_has_prop_on_mol_block(mol_block, mol_prop_key))
-
     # I will check if each block of every molecule has all the tags:
     #  'MASS SPECTRAL PEAKS', 'INCHIKEY', 'INCHI', NAME', 'EXACT MASS'
-    return np.all(prop_check_status)
+    # in the order of _CHECK_PROP_TAG_LINES, stopping at the first one missing.
+    return all(prop_tag_line in mol_block for prop_tag_line in _CHECK_PROP_TAG_LINES)
+
 
+def _process_mol_str(mol_str):
+    """ Convert a molecule string read from a sdf-like data file to a molecule block.
 
-def _max_atoms_in_mol_block(mol_block_list):
-    max_num_atoms = -1024
-    for mol_block in mol_block_list:
-        mol_str = '\n'.join(mol_block)
-        mol = pybel.readstring('sdf', mol_str)
-        if len(mol.atoms) > max_num_atoms:
-            max_num_atoms = len(mol.atoms)
-    return max(max_num_atoms, 0)
+    Molecule strings are independent of each other, so this runs in worker processes of convert_to_sdf.
 
+    Args:
+        mol_str: A string for molecule descriptions.
+
+    Returns:
+        A tuple (valid_mol_block, failed_mol_block, num_atoms). valid_mol_block is the molecule block if it has all
+        the considered properties, otherwise, None. failed_mol_block is the molecule block if it lacks any of them,
+        otherwise, None. num_atoms is the number of atoms of the valid molecule block, or 0 if there is none.
+    """
 
-def convert_to_sdf(path_to_bad_sdf, failed_block_file_name=None, output_dir=None):
+    mol_block, num_atoms = _make_mol_block_rational(_make_mol_block_from_string(mol_str))
+    if mol_block is None:
+        return None, None, 0
+    if _check_mol_block_has_all_prop(mol_block):
+        return mol_block, None, num_atoms
+    return None, mol_block, 0
+
+
+def _init_worker():
+    """ Initialize a worker process converting molecule strings.
+
+    Molecule blocks RDKit rejects in _make_mol_block_rational are expected and go on to OpenBabel, so RDKit logs
+    are disabled once in each worker process rather than logging an error for every one of them.
+    """
+    RDLogger.DisableLog('rdApp.*')
+
+
+def _process_mol_str_list(mol_str_list, num_workers=None):
+    """ Convert molecule strings read from a sdf-like data file to molecule blocks, in order.
+
+    Args:
+        mol_str_list: A list of string for molecules.
+        num_workers: Number of processes to convert molecule strings in parallel. If it is 1, molecule strings are
+            converted in the current process, without starting any worker process, and RDKit logs are left as
+            they are.
+
+    Yields:
+        A tuple (valid_mol_block, failed_mol_block, num_atoms) for each molecule string, see _process_mol_str.
+    """
+
+    if num_workers == 1:
+        for result in map(_process_mol_str, mol_str_list):
+            yield result
+        return
+
+    with futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker) as executor:
+        for result in executor.map(_process_mol_str, mol_str_list, chunksize=64):
+            yield result
+
+
+def convert_to_sdf(path_to_bad_sdf, failed_block_file_name=None, output_dir=None, num_workers=None):
     """ Make a sdf-like data file converted to sdf.
 
     Note that to form a proper molecule block, some missing lines in header of original molecule string read from
@@ -235,51 +399,55 @@ def convert_to_sdf(path_to_bad_sdf, failed_block_file_name=None, output_dir=None
             blocks are skipped, no failed molecule block written to file.
         output_dir: Directory to the converted sdf file if set.  By default (None), the directory of the sdf-like data
             file will be set as output directory.
+        num_workers: Number of processes to convert molecule strings in parallel. By default (None), it is the
+            number of processors on the machine. If it is 1, molecule strings are converted in the current process.
     Returns:
-        valid_mol_block_list: A list of molecular blocks converted successfully
-        failed_mol_block_list: A list of molecular blocks corrupted.
+        valid_mol_block_list: A list of molecular blocks (string) converted successfully
+        failed_mol_block_list: A list of molecular blocks (string) corrupted.
         num_valid_mol_block: How many numbers of molecular blocks converted successfully.
         num_failed_mol_block: How many numbers of molecular blocks are so corrupted that they can not be converted.
         max_num_atoms: Maximum number of atoms in those molecules converted successfully.
+
+    Raises:
+        ValueError if num_workers is set but less than 1.
     """
 
-    suppl = Chem.SDMolSupplier(path_to_bad_sdf)
+    if num_workers is not None and num_workers < 1:
+        raise ValueError('num_workers should be at least 1, but got %d.' % num_workers)
 
-    mol_block_list = []
     logging.warning('Converting started ...')
-    for index in range(len(suppl)):
-        # all string leading to each four dollar signs($$$$) will take as molecule-related string.
-        mol_str = suppl.GetItemText(index).strip().splitlines()
-        mol_block = _make_mol_block_rational(_make_mol_block_from_string(mol_str))
-
-        if mol_block is not None:
-            mol_block_list.append(mol_block)
-
-    num_failed = 0
-    valid_mol_block_list = []
-    failed_mol_block_list = []
-    for mol_block in mol_block_list:
-        if _check_mol_block_has_all_prop(mol_block):
-            valid_mol_block_list.append(mol_block)
-        else:
-            num_failed += 1
-            failed_mol_block_list.append(mol_block)
+    # all string leading to each four dollar signs($$$$) will take as molecule-related string.
+    mol_str_list = _read_mol_str_list(path_to_bad_sdf)
+
+    # there are at most as many valid or failed molecule blocks as molecule strings, so that both lists are
+    # allocated once and trimmed to their sizes at the end rather than growing molecule by molecule.
+    max_num_atoms = 0
+    num_valid_mol_block = 0
+    num_failed_mol_block = 0
+    valid_mol_block_list = [None] * len(mol_str_list)
+    failed_mol_block_list = [None] * len(mol_str_list)
+    for valid_mol_block, failed_mol_block, num_atoms in _process_mol_str_list(mol_str_list, num_workers):
+        if valid_mol_block is not None:
+            valid_mol_block_list[num_valid_mol_block] = valid_mol_block
+            num_valid_mol_block += 1
+            max_num_atoms = max(max_num_atoms, num_atoms)
+        elif failed_mol_block is not None:
+            failed_mol_block_list[num_failed_mol_block] = failed_mol_block
+            num_failed_mol_block += 1
+    del valid_mol_block_list[num_valid_mol_block:]
+    del failed_mol_block_list[num_failed_mol_block:]
 
     out_dir, sdf_name = os.path.split(path_to_bad_sdf)
-    if output_dir is '':
-        output_dir = os.path.abspath(out_dir)
+    if not output_dir:
+        output_dir = out_dir
     output_dir = os.path.abspath(output_dir)
     save_valid_mol_block_to_path = os.path.join(output_dir, ('converted_%s' % sdf_name))
-    save_failed_mol_block_to_path = os.path.join(output_dir, failed_block_file_name)
 
-    max_num_atoms = 0
     if valid_mol_block_list:
         _write_mol_block_to_file(save_valid_mol_block_to_path, valid_mol_block_list)
-        max_num_atoms = _max_atoms_in_mol_block(valid_mol_block_list)
     if failed_block_file_name and failed_mol_block_list:
+        save_failed_mol_block_to_path = os.path.join(output_dir, failed_block_file_name)
         _write_mol_block_to_file(save_failed_mol_block_to_path, failed_mol_block_list)
-    num_valid_mol_block = len(valid_mol_block_list)
-    num_failed_mol_block = len(failed_mol_block_list)
     logging.warning(('Processing on %s from Massbank of North America (MoNA) finished. '
                      'Except for %d failed molecule blocks, totally, '
                      '%d molecules have been converted to a read-friendly SDF saved in the path %s. '
@@ -290,7 +458,7 @@ def convert_to_sdf(path_to_bad_sdf, failed_block_file_name=None, output_dir=None
 
 def main(_):
     tf.gfile.MkDir(FLAGS.output_dir)
-    convert_to_sdf(FLAGS.path_to_bad_sdf, FLAGS.failed_block_file_name, FLAGS.output_dir)
+    convert_to_sdf(FLAGS.path_to_bad_sdf, FLAGS.failed_block_file_name, FLAGS.output_dir, FLAGS.num_workers)
 
 
 if __name__ == '__main__':
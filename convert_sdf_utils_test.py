@@ -21,6 +21,7 @@ import tensorflow as tf
 from absl import flags
 from absl.testing import absltest
 from absl.testing import parameterized
+from rdkit import Chem
 
 import convert_sdf_utils
 
@@ -30,6 +31,24 @@ def _make_test_dir(relative_path):
         flags.FLAGS.test_srcdir, os.path.split(os.path.abspath(__file__))[0], relative_path)
 
 
+def _make_mol_block(comment_value, name_value='Methane'):
+    return '\n'.join([
+        'Methane',
+        '',
+        '',
+        '  1  0  0  0  0  0  0  0  0  0999 V2000',
+        '    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0',
+        'M  END',
+        '>  <NAME>',
+        name_value,
+        '',
+        '>  <COMMENT>',
+        comment_value,
+        'cas number=74-82-8',
+        '',
+        '$$$$'])
+
+
 class ConvertSDFUtilsTest(tf.test.TestCase, parameterized.TestCase):
 
     def setUp(self):
@@ -40,6 +59,15 @@ class ConvertSDFUtilsTest(tf.test.TestCase, parameterized.TestCase):
     def tearDown(self):
         tf.gfile.DeleteRecursively(self.out_dir)
 
+    def _make_test_sdf_head(self, num_mol):
+        """Copy the first molecules of the test dataset to the output directory."""
+        with tf.gfile.Open(self.test_bad_sdf_name, 'rb') as reader:
+            raw_mol_strs = reader.read().split(b'$$$$')
+        bad_sdf_name = os.path.join(self.out_dir, 'MoNA-export-HMDB-head.sdf')
+        with tf.gfile.Open(bad_sdf_name, 'wb') as writer:
+            writer.write(b'$$$$'.join(raw_mol_strs[:num_mol]) + b'$$$$\r\n')
+        return bad_sdf_name
+
     def test_convert_to_sdf(self):
         _, _, num_mol, num_failed_mol_block, max_num_atoms = convert_sdf_utils.convert_to_sdf(
             self.test_bad_sdf_name,
@@ -53,6 +81,181 @@ class ConvertSDFUtilsTest(tf.test.TestCase, parameterized.TestCase):
         self.assertEqual(num_failed_mol_block, expected_num_failed_mol_block)
         self.assertEqual(max_num_atoms, expected_max_num_atoms)
 
+        # the converted sdf should be loaded back by RDKit, with hydrogens kept to count atoms as converted.
+        converted_sdf_name = os.path.join(self.out_dir, 'converted_MoNA-export-HMDB.sdf')
+        mols = list(Chem.SDMolSupplier(converted_sdf_name, removeHs=False))
+        self.assertEqual(len(mols), expected_num_mol)
+        self.assertTrue(all(mol is not None for mol in mols))
+        self.assertTrue(all(mol.GetProp(convert_sdf_utils.SDF_TAG_NAME) for mol in mols))
+        self.assertTrue(all(mol.GetProp(convert_sdf_utils.SDF_TAG_INCHIKEY) for mol in mols))
+        self.assertEqual(mols[0].GetProp(convert_sdf_utils.SDF_TAG_NAME), '1-Methylhistidine')
+        self.assertEqual(mols[0].GetProp(convert_sdf_utils.SDF_TAG_INCHIKEY), 'BRMWTNUJHUMWMS-LURJTMIESA-N')
+        self.assertEqual(max(mol.GetNumAtoms() for mol in mols), expected_max_num_atoms)
+
+    def test_convert_to_sdf_in_process(self):
+        bad_sdf_name = self._make_test_sdf_head(100)
+
+        in_process_results = convert_sdf_utils.convert_to_sdf(
+            bad_sdf_name, failed_block_file_name='failed_blocks.sdf', output_dir=self.out_dir, num_workers=1)
+        in_pool_results = convert_sdf_utils.convert_to_sdf(
+            bad_sdf_name, failed_block_file_name='failed_blocks.sdf', output_dir=self.out_dir, num_workers=2)
+
+        self.assertEqual(in_process_results, in_pool_results)
+
+    def test_convert_to_sdf_with_invalid_num_workers(self):
+        with self.assertRaisesRegex(ValueError, 'num_workers should be at least 1'):
+            convert_sdf_utils.convert_to_sdf(self.test_bad_sdf_name, output_dir=self.out_dir, num_workers=0)
+
+    def test_convert_to_sdf_with_defaults(self):
+        # a copy of the first molecules of the test dataset, converted next to it.
+        bad_sdf_name = self._make_test_sdf_head(5)
+
+        _, _, num_mol, num_failed_mol_block, _ = convert_sdf_utils.convert_to_sdf(bad_sdf_name)
+
+        self.assertEqual(num_mol, 5)
+        self.assertEqual(num_failed_mol_block, 0)
+        self.assertCountEqual(tf.gfile.ListDirectory(self.out_dir),
+                              ['MoNA-export-HMDB-head.sdf', 'converted_MoNA-export-HMDB-head.sdf'])
+
+    @parameterized.named_parameters(
+        ('double_prefix', 'InChI=InChI=1S/CH4/h1H4', '1S/CH4/h1H4'),
+        ('single_prefix', 'InChI=1S/CH4/h1H4', '1S/CH4/h1H4'),
+        # InChIs ending in a character of 'InChI=', which used to be stripped along with the prefix.
+        ('ending_in_h', 'InChI=InChI=1S/CH4/h', '1S/CH4/h'),
+        ('ending_in_equal_sign', 'InChI=InChI=1S/CH4/h1H4=', '1S/CH4/h1H4='),
+        ('trailing_whitespace', 'InChI=InChI=1S/CH4/h1H4  \t', '1S/CH4/h1H4'),
+        ('not_inchi', 'SMILES=C', ''))
+    def test_get_inchi_from_mol_block(self, comment_value, expected_inchi):
+        mol_block = _make_mol_block(comment_value)
+
+        self.assertEqual(
+            convert_sdf_utils._get_prop_value_from_mol_block(mol_block, convert_sdf_utils.SDF_TAG_INCHI),
+            expected_inchi)
+
+    def test_get_prop_value_from_mol_block(self):
+        mol_block = _make_mol_block('SMILES=C', name_value='Methane  ')
+
+        self.assertEqual(
+            convert_sdf_utils._get_prop_value_from_mol_block(mol_block, convert_sdf_utils.SDF_TAG_NAME), 'Methane')
+        self.assertEqual(
+            convert_sdf_utils._get_prop_value_from_mol_block(mol_block, convert_sdf_utils.SDF_TAG_MOLECULE_MASS), '')
+
+    def test_get_prop_value_from_mol_block_with_trailing_whitespace_on_tag_line(self):
+        mol_block = _make_mol_block('InChI=InChI=1S/CH4/h1H4')
+        mol_block = mol_block.replace('>  <NAME>', '>  <NAME> \t').replace('>  <COMMENT>', '>  <COMMENT>\r')
+
+        self.assertEqual(
+            convert_sdf_utils._get_prop_value_from_mol_block(mol_block, convert_sdf_utils.SDF_TAG_NAME), 'Methane')
+        self.assertEqual(
+            convert_sdf_utils._get_prop_value_from_mol_block(mol_block, convert_sdf_utils.SDF_TAG_INCHI),
+            '1S/CH4/h1H4')
+
+    def test_get_unsupported_prop_value_from_mol_block(self):
+        mol_block = _make_mol_block('SMILES=C')
+
+        with self.assertRaisesRegex(ValueError, 'COMMENT is not a supported property type.'):
+            convert_sdf_utils._get_prop_value_from_mol_block(mol_block, 'COMMENT')
+
+    @parameterized.named_parameters(
+        ('ending_in_mol_end_mark', 'first\r\n$$$$\r\nsecond\r\n$$$$\r\n', ['first\r\n$$$$', '\r\nsecond\r\n$$$$']),
+        ('blank_mol_strs', 'first\n$$$$\n\n$$$$\n$$$$\nsecond\n$$$$\n', ['first\n$$$$', '\nsecond\n$$$$']),
+        ('not_ending_in_mol_end_mark', 'first\n$$$$\nsecond\n', ['first\n$$$$', '\nsecond\n']),
+        ('mol_end_mark_in_prop_value',
+         'first\n>  <COMMENT>\ncost $$$$\n\n$$$$ \nsecond\n$$$$\n',
+         ['first\n>  <COMMENT>\ncost $$$$\n\n$$$$', '\nsecond\n$$$$']))
+    def test_read_mol_str_list(self, sdf_content, expected_mol_str_list):
+        sdf_name = os.path.join(self.out_dir, 'test.sdf')
+        with tf.gfile.Open(sdf_name, 'w') as writer:
+            writer.write(sdf_content)
+
+        self.assertEqual(convert_sdf_utils._read_mol_str_list(sdf_name), expected_mol_str_list)
+
+    def test_make_mol_block_from_string(self):
+        # MoNA mixes '\r\n' and '\n' line breaks, and misses a header line and 'M  END'.
+        mol_str = ('\r\n  CDK     10281914412D\r\n\r\n'
+                   '  1  0  0  0  0  0  0  0  0  0999 V2000\n'
+                   '    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0\r\n'
+                   '>  <NAME>\r\nMethane\r\n\r\n'
+                   '>  <COMMENT>\nInChI=InChI=1S/CH4/h1H4\r\n\r\n'
+                   '$$$$')
+        expected_mol_block = '\n'.join([
+            'CDK     10281914412D',
+            '',
+            '',
+            '  1  0  0  0  0  0  0  0  0  0999 V2000',
+            '    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0',
+            'M  END',
+            '>  <NAME>',
+            'Methane',
+            '',
+            '>  <COMMENT>',
+            'InChI=InChI=1S/CH4/h1H4',
+            '',
+            '>  <INCHI>',
+            '1S/CH4/h1H4',
+            '',
+            '>  <INCHIKEY>',
+            'VNWKTOKETHGBQD-UHFFFAOYSA-N',
+            '',
+            '$$$$'])
+
+        self.assertEqual(convert_sdf_utils._make_mol_block_from_string(mol_str), expected_mol_block)
+
+    def test_make_mol_block_rational_loaded_by_rdkit(self):
+        mol_str = _make_mol_block('SMILES=C')
+
+        mol_block, num_atoms = convert_sdf_utils._make_mol_block_rational(mol_str)
+
+        self.assertEqual(mol_block, mol_str + '\n')
+        self.assertEqual(num_atoms, 1)
+
+    def test_make_mol_block_rational_calibrated_by_openbabel(self):
+        # a carbon with five hydrogens, whose valence RDKit rejects but OpenBabel does not check.
+        mol_str = '\n'.join([
+            'Pentahydridocarbon',
+            '',
+            '',
+            '  6  5  0  0  0  0  0  0  0  0999 V2000',
+            '    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0',
+            '    1.0000    0.0000    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0',
+            '   -1.0000    0.0000    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0',
+            '    0.0000    1.0000    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0',
+            '    0.0000   -1.0000    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0',
+            '    0.0000    0.0000    1.0000 H   0  0  0  0  0  0  0  0  0  0  0  0',
+            '  1  2  1  0  0  0  0',
+            '  1  3  1  0  0  0  0',
+            '  1  4  1  0  0  0  0',
+            '  1  5  1  0  0  0  0',
+            '  1  6  1  0  0  0  0',
+            'M  END',
+            '$$$$'])
+
+        mol_block, num_atoms = convert_sdf_utils._make_mol_block_rational(mol_str)
+
+        self.assertIsNone(Chem.MolFromMolBlock(mol_str, removeHs=False))
+        self.assertIsNotNone(mol_block)
+        self.assertIn('OpenBabel', mol_block)
+        self.assertEqual(num_atoms, 6)
+
+    def test_make_mol_block_from_string_with_inchikey(self):
+        mol_str = '\n'.join([
+            'Methane',
+            '',
+            '  1  0  0  0  0  0  0  0  0  0999 V2000',
+            '    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0',
+            '>  <NAME>',
+            'Methane',
+            '',
+            '>  <INCHIKEY>',
+            'VNWKTOKETHGBQD-UHFFFAOYSA-N',
+            '',
+            '$$$$'])
+
+        mol_block = convert_sdf_utils._make_mol_block_from_string(mol_str)
+
+        self.assertEqual(mol_block.count('>  <INCHIKEY>'), 1)
+        self.assertEqual(mol_block.count('>  <INCHI>'), 1)
+
 
 if __name__ == '__main__':
     tf.test.main()